@@ -2,6 +2,10 @@
 Основной граф
 '''
 import json
+import re
+from collections import deque
+from functools import lru_cache
+import orjson
 from langgraph.graph import StateGraph, START, END
 from langgraph.checkpoint.memory import MemorySaver
 from langchain_core.messages import SystemMessage, HumanMessage, AIMessage, ToolMessage
@@ -32,6 +36,11 @@ llm = ChatGroq(model="llama-3.3-70b-versatile",
                 "frequency_penalty": 0.5,
             })
 
+# Привязки инструментов строятся один раз: bind_tools сериализует JSON-схемы инструментов
+_LLM_SQL_REQUIRED = llm.bind_tools([run_sql], tool_choice="required")
+_LLM_SQL_OPTIONAL = llm.bind_tools([run_sql])
+_LLM_TOOLS_BOTH = llm.bind_tools([run_sql, get_postgres_schema])
+
 
 JSON_HINTS = """
 ВАЖНО — работа с JSON/JSONB колонками:
@@ -49,107 +58,59 @@ VIS_KEYWORDS = [
 ]
 
 
+_VIS_RE = re.compile("|".join(map(re.escape, VIS_KEYWORDS)), re.IGNORECASE)
+
+
 def _is_vis_request(text: str) -> bool:
     """Проверяет, является ли текст запросом на визуализацию."""
-    text_lower = text.lower()
-    return any(kw in text_lower for kw in VIS_KEYWORDS)
+    return _VIS_RE.search(text) is not None
 
 
-def _schema_for_prompt(max_chars: int = 12000) -> str:
-    """Ограничивает размер схемы в промпте, чтобы не раздувать контекст."""
-    schema = DB_SCHEMA or "Схема БД недоступна"
-    if len(schema) <= max_chars:
-        return schema
-    return f"{schema[:max_chars]}\n\n...[schema truncated]..."
-
+_SCHEMA_CACHE: dict[tuple[int, int], tuple[str, str]] = {}
 
-def _final_no_data_message(original_query: str) -> str:
-    query = (original_query or "").strip()
-    if not query:
-        return (
-            "По текущему запросу не найдено данных. "
-            "Уточните период, фильтры или названия сущностей и попробуйте снова."
-        )
-    return (
-        f"По запросу «{query}» данные не найдены. "
-        "Проверьте условия фильтрации, диапазон дат или формулировку запроса."
-    )
 
+def _schema_for_prompt(max_chars: int = 12000) -> str:
+    """Ограничивает размер схемы в промпте, чтобы не раздувать контекст.
 
-def assistant(state: AgentState):
-    messages = state["messages"]
-    last_msg = messages[-1] if messages else None
-    critic_attempts = state.get("critic_attempts", 0)
+    Результат кэшируется по объекту DB_SCHEMA: пока схема не перезагружена,
+    возвращается тот же самый объект строки без повторной нарезки.
+    """
+    schema = DB_SCHEMA or "Схема БД недоступна"
+    key = (id(schema), max_chars)
+    cached = _SCHEMA_CACHE.get(key)
+    if cached is not None and cached[0] is schema:
+        return cached[1]
 
-    if isinstance(last_msg, ToolMessage) and getattr(last_msg, "name", "") == "run_sql":
-        try:
-            parsed = json.loads(last_msg.content)
-            if parsed.get("success") and int(parsed.get("row_count", 0)) == 0:
-                return {"messages": [AIMessage(content=_final_no_data_message(state.get("original_query", "")))]}
-        except Exception:
-            pass
-
-    if (
-        critic_attempts >= 3
-        and isinstance(last_msg, ToolMessage)
-        and getattr(last_msg, "name", "") == "run_sql"
-    ):
-        try:
-            parsed = json.loads(last_msg.content)
-            if parsed.get("success") and int(parsed.get("row_count", 0)) == 0:
-                return {"messages": [AIMessage(content=_final_no_data_message(state.get("original_query", "")))]}
-            if not parsed.get("success"):
-                err = str(parsed.get("error", "")).strip()
-                if err:
-                    return {
-                        "messages": [
-                            AIMessage(
-                                content=(
-                                    "Не удалось получить данные из БД после нескольких попыток. "
-                                    f"Последняя ошибка: {err[:220]}"
-                                )
-                            )
-                        ]
-                    }
-        except Exception:
-            pass
-
-    MAX_HISTORY = 12
-    if len(messages) > MAX_HISTORY:
-        messages_for_llm = list(messages[-MAX_HISTORY:])
+    if len(schema) <= max_chars:
+        prompt = schema
     else:
-        messages_for_llm = list(messages)
+        prompt = f"{schema[:max_chars]}\n\n...[schema truncated]..."
+    stale = [k for k, (source, _) in _SCHEMA_CACHE.items() if source is not schema]
+    for k in stale:
+        del _SCHEMA_CACHE[k]
+    _SCHEMA_CACHE[key] = (schema, prompt)
+    return prompt
 
-    came_from_critic = (
-        isinstance(last_msg, AIMessage) and
-        getattr(last_msg, "name", None) == "sql_critic"
-    )
 
-    has_data_to_present = False
-    query_result = state.get("query_result", [])
-    if query_result and isinstance(query_result, list) and len(query_result) > 0:
-        has_data_to_present = True
+def _reset_schema_caches():
+    """Сбрасывает всё, что собрано из DB_SCHEMA: срез схемы и готовые системные промпты."""
+    _SCHEMA_CACHE.clear()
+    _system_messages.cache_clear()
+    _critic_system_message.cache_clear()
 
-    original_query = state.get("original_query", "")
-    is_vis = _is_vis_request(original_query)
-    schema_prompt = _schema_for_prompt()
 
-    if came_from_critic:
-        llm_with_tools = llm.bind_tools([run_sql], tool_choice="required")
-        system_content = f"""Критик указал на ошибку. Схема БД:
-{schema_prompt}
-{JSON_HINTS}
+SCHEMA_BLOCK = """Схема БД:
+{schema}
+{json_hints}"""
+
+SYSTEM_CRITIC_FIX = """Критик указал на ошибку.
 
 Прочитай критику выше и СЕЙЧАС ЖЕ:
 1. Напиши исправленный SQL
 2. Вызови run_sql
 НЕ ПИШИ НИКАКОГО ТЕКСТА — ТОЛЬКО инструмент!"""
 
-    elif is_vis and not has_data_to_present:
-        llm_with_tools = llm.bind_tools([run_sql], tool_choice="required")
-        system_content = f"""Ты — SQL-агент с возможностью визуализации. Схема БД:
-{schema_prompt}
-{JSON_HINTS}
+SYSTEM_VIS_FETCH = """Ты — SQL-агент с возможностью визуализации.
 
 Пользователь просит визуализировать данные.
 Данных в текущем состоянии НЕТ — нужно их получить.
@@ -161,9 +122,7 @@ def assistant(state: AgentState):
 
 НЕ ПИШИ ТЕКСТ. НЕ ГОВОРИ, ЧТО НЕ МОЖЕШЬ. Просто вызови run_sql!"""
 
-    elif has_data_to_present:
-        llm_with_tools = llm.bind_tools([run_sql])
-        system_content = f"""Ты — SQL-аналитик. Данные УЖЕ получены из базы (последний ToolMessage).
+SYSTEM_PRESENT = """Ты — SQL-аналитик. Данные УЖЕ получены из базы (последний ToolMessage).
 
 Твоя задача:
 1. **Кратко ответь на вопрос пользователя**, опираясь только на полученные данные.
@@ -177,11 +136,7 @@ def assistant(state: AgentState):
 
 Пиши ответ строго в одном сообщении, таблица должна быть валидной Markdown-таблицей."""
 
-    else:
-        llm_with_tools = llm.bind_tools([run_sql, get_postgres_schema])
-        system_content = f"""Ты — SQL-агент. Схема БД:
-{schema_prompt}
-{JSON_HINTS}
+SYSTEM_DEFAULT = """Ты — SQL-агент.
 
 Правила:
 - Для любых вопросов о данных → сразу вызывай run_sql
@@ -190,41 +145,220 @@ def assistant(state: AgentState):
 - После получения данных — сразу пиши красивый ответ
 - Если вопрос не про данные — скажи, что ты работаешь только с базой"""
 
-    system_msg = SystemMessage(content=system_content)
-    
+SYSTEM_RETRY = """Ты — SQL-агент.
+
+Напиши ОДИН короткий SQL SELECT запрос для ответа на вопрос пользователя.
+Используй ТОЛЬКО таблицы и колонки из схемы. Запрос должен быть максимально простым.
+Вызови run_sql с этим запросом."""
+
+
+# Промпт подачи данных не зависит от схемы — собирается один раз при импорте
+_SYSTEM_PRESENT_MSG = SystemMessage(content=SYSTEM_PRESENT)
+
+
+@lru_cache(maxsize=1)
+def _system_messages(schema_prompt: str) -> dict[str, SystemMessage]:
+    """Собирает системные промпты один раз на версию схемы.
+
+    Один и тот же объект SystemMessage переиспользуется между шагами графа,
+    поэтому префикс запроса байт-в-байт совпадает и попадает в prompt cache провайдера.
+    Блок схемы стоит первым и общий для всех веток — различается только хвост
+    с инструкциями. Groq принимает system только строкой, поэтому блоки склеиваются.
+    """
+    schema_block = SCHEMA_BLOCK.format(schema=schema_prompt, json_hints=JSON_HINTS)
+
+    def build(instructions: str) -> SystemMessage:
+        return SystemMessage(content=f"{schema_block}\n\n{instructions}")
+
+    return {
+        "critic_fix": build(SYSTEM_CRITIC_FIX),
+        "vis_fetch": build(SYSTEM_VIS_FETCH),
+        "default": build(SYSTEM_DEFAULT),
+        "retry": build(SYSTEM_RETRY),
+    }
+
+
+_NO_DATA_TEXT = (
+    "По текущему запросу не найдено данных. "
+    "Уточните период, фильтры или названия сущностей и попробуйте снова."
+)
+
+# Неизменяемые ответы на ошибки LLM: один объект на процесс вместо нового на каждый сбой
+_ERR_TEMPORARY = AIMessage(content="Произошла временная ошибка. Пожалуйста, попробуйте ещё раз.")
+_ERR_MALFORMED = AIMessage(
+    content="Произошла ошибка при формировании запроса. Пожалуйста, попробуйте переформулировать ваш вопрос проще."
+)
+
+
+def _final_no_data_message(original_query: str) -> str:
+    query = (original_query or "").strip()
+    if not query:
+        return _NO_DATA_TEXT
+    return (
+        f"По запросу «{query}» данные не найдены. "
+        "Проверьте условия фильтрации, диапазон дат или формулировку запроса."
+    )
+
+
+def _loads(content):
+    """orjson.loads с откатом на json.loads (orjson строже: не принимает NaN/Infinity)."""
+    try:
+        return orjson.loads(content)
+    except orjson.JSONDecodeError:
+        return json.loads(content)
+
+
+@lru_cache(maxsize=128)
+def _parse_tool_content(content: str) -> dict | None:
     try:
-        response = llm_with_tools.invoke([system_msg] + messages_for_llm)
+        parsed = _loads(content)
+    except (json.JSONDecodeError, ValueError, TypeError):
+        return None
+    return parsed if isinstance(parsed, dict) else None
+
+
+def _parsed(msg) -> dict | None:
+    """JSON-результат инструмента из ToolMessage или None, если это не JSON-объект.
+
+    Разбор кэшируется по тексту сообщения: один и тот же ToolMessage
+    читают assistant и роутер, а также цикл подсчёта пустых выборок.
+    Возвращаемый dict общий для всех вызовов — его нельзя изменять.
+    """
+    content = getattr(msg, "content", None)
+    if not isinstance(content, str):
+        return None
+    return _parse_tool_content(content)
+
+
+MAX_HISTORY = 12
+
+
+def _last_human_index(messages) -> int | None:
+    """Индекс последнего HumanMessage — вопроса текущего запроса к графу."""
+    for i in range(len(messages) - 1, -1, -1):
+        if isinstance(messages[i], HumanMessage):
+            return i
+    return None
+
+
+def _trim_history(messages):
+    """Обрезает историю для LLM, сохраняя неизменное начало.
+
+    Если вопрос текущего запроса (последний HumanMessage) уходит за окно, он
+    закрепляется первым, а сдвигается только хвост: позиция вопроса внутри
+    запроса не меняется, так что префикс стабилен между шагами графа.
+    ToolMessage в начале хвоста отбрасываются: их tool_call остался за окном.
+    """
+    if len(messages) <= MAX_HISTORY:
+        return messages
+
+    head = _last_human_index(messages)
+    start = len(messages) - MAX_HISTORY
+    if head is not None and head < start:
+        start = max(start + 1, head + 1)
+    else:
+        head = None
+    while start < len(messages) and isinstance(messages[start], ToolMessage):
+        start += 1
+    if head is None:
+        return messages[start:]
+    return [messages[head], *messages[start:]]
+
+
+def _maybe_no_data_reply(parsed: dict | None, state: AgentState) -> dict | None:
+    """Готовый ответ «данных нет», если run_sql успешно вернул 0 строк."""
+    if not parsed or not parsed.get("success"):
+        return None
+    try:
+        if int(parsed.get("row_count", 0)) != 0:
+            return None
+    except (TypeError, ValueError):
+        return None
+    return {"messages": [AIMessage(content=_final_no_data_message(state.get("original_query", "")))]}
+
+
+async def assistant(state: AgentState):
+    messages = state["messages"]
+    last_msg = messages[-1] if messages else None
+    critic_attempts = state.get("critic_attempts", 0)
+
+    parsed = None
+    if getattr(last_msg, "type", None) == "tool" and getattr(last_msg, "name", "") == "run_sql":
+        parsed = _parsed(last_msg)
+
+    no_data_reply = _maybe_no_data_reply(parsed, state)
+    if no_data_reply is not None:
+        return no_data_reply
+
+    if parsed and critic_attempts >= 3 and not parsed.get("success"):
+        err = str(parsed.get("error", "")).strip()
+        if err:
+            return {
+                "messages": [
+                    AIMessage(
+                        content=(
+                            "Не удалось получить данные из БД после нескольких попыток. "
+                            f"Последняя ошибка: {err[:220]}"
+                        )
+                    )
+                ]
+            }
+
+    messages_for_llm = _trim_history(messages)
+
+    came_from_critic = (
+        isinstance(last_msg, AIMessage) and
+        getattr(last_msg, "name", None) == "sql_critic"
+    )
+
+    has_data_to_present = False
+    query_result = state.get("query_result", [])
+    if query_result and isinstance(query_result, list) and len(query_result) > 0:
+        has_data_to_present = True
+
+    original_query = state.get("original_query", "")
+    is_vis = _is_vis_request(original_query)
+
+    if came_from_critic:
+        llm_with_tools = _LLM_SQL_REQUIRED
+        system_msg = _system_messages(_schema_for_prompt())["critic_fix"]
+
+    elif is_vis and not has_data_to_present:
+        llm_with_tools = _LLM_SQL_REQUIRED
+        system_msg = _system_messages(_schema_for_prompt())["vis_fetch"]
+
+    elif has_data_to_present:
+        llm_with_tools = _LLM_SQL_OPTIONAL
+        system_msg = _SYSTEM_PRESENT_MSG
+
+    else:
+        llm_with_tools = _LLM_TOOLS_BOTH
+        system_msg = _system_messages(_schema_for_prompt())["default"]
+
+    try:
+        response = await llm_with_tools.ainvoke([system_msg, *messages_for_llm])
     except Exception as e:
         error_str = str(e)
         if "tool_use_failed" in error_str or "failed_generation" in error_str:
             logger.warning(f"⚠️ LLM сгенерировал невалидный tool_call, повтор с упрощённым промптом: {error_str[:200]}")
             try:
-                retry_system = SystemMessage(content=f"""Ты — SQL-агент. Схема БД:
-{schema_prompt}
-{JSON_HINTS}
-
-Напиши ОДИН короткий SQL SELECT запрос для ответа на вопрос пользователя.
-Используй ТОЛЬКО таблицы и колонки из схемы. Запрос должен быть максимально простым.
-Вызови run_sql с этим запросом.""")
-                retry_messages = [m for m in messages_for_llm if isinstance(m, HumanMessage)][-1:]
-                retry_llm = llm.bind_tools([run_sql], tool_choice="required")
-                response = retry_llm.invoke([retry_system] + retry_messages)
+                retry_system = _system_messages(_schema_for_prompt())["retry"]
+                question_idx = _last_human_index(messages)
+                retry_messages = [messages[question_idx]] if question_idx is not None else []
+                response = await _LLM_SQL_REQUIRED.ainvoke([retry_system, *retry_messages])
             except Exception as retry_e:
                 logger.error(f"❌ Повторная попытка тоже не удалась: {retry_e}")
-                response = AIMessage(content="Произошла ошибка при формировании запроса. Пожалуйста, попробуйте переформулировать ваш вопрос проще.")
+                response = _ERR_MALFORMED
         else:
             logger.error(f"❌ Ошибка LLM: {error_str[:300]}")
-            response = AIMessage(content="Произошла временная ошибка. Пожалуйста, попробуйте ещё раз.")
+            response = _ERR_TEMPORARY
 
     return {
         "messages": [response]
     }
 
-CRITIC_PROMPT = """Ты — строгий SQL-ревьюер. Анализируй ошибку и давай КОНКРЕТНОЕ решение.
-
-Исходный вопрос: {original_query}
-Неправильный SQL: {last_sql}
-Ошибка: {tool_result}
+CRITIC_PREFIX = """Ты — строгий SQL-ревьюер. Анализируй ошибку и давай КОНКРЕТНОЕ решение.
+Исходный вопрос, неправильный SQL и ошибка придут следующим сообщением.
 
 ПОЛНАЯ СХЕМА БД:
 {schema_preview}
@@ -258,7 +392,18 @@ CRITIC_PROMPT = """Ты — строгий SQL-ревьюер. Анализир
 
 Будь максимально конкретным! Используй ТОЛЬКО таблицы и колонки из схемы выше. Пиши SQL ПОЛНОСТЬЮ!"""
 
-def critic_node(state: AgentState):
+CRITIC_TAIL = """Исходный вопрос: {original_query}
+Неправильный SQL: {last_sql}
+Ошибка: {tool_result}"""
+
+
+@lru_cache(maxsize=1)
+def _critic_system_message(schema_preview: str) -> SystemMessage:
+    """Статичная часть промпта критика (правила + схема), одна на версию схемы."""
+    return SystemMessage(content=CRITIC_PREFIX.format(schema_preview=schema_preview))
+
+
+async def critic_node(state: AgentState):
     global DB_SCHEMA
     logger.info("🧐 Запущен критик")
     
@@ -267,7 +412,7 @@ def critic_node(state: AgentState):
     
     last_tool_msg = None
     for m in reversed(state["messages"]):
-        if isinstance(m, ToolMessage) and m.name == "run_sql":
+        if getattr(m, "type", None) == "tool" and getattr(m, "name", "") == "run_sql":
             last_tool_msg = m
             break
     
@@ -276,18 +421,19 @@ def critic_node(state: AgentState):
         return {**state, "critic_attempts": critic_attempts}
     
     if not DB_SCHEMA:
-        DB_SCHEMA = get_postgres_schema.invoke({})
-    schema_preview = _schema_for_prompt()
-
-    prompt = CRITIC_PROMPT.format(
-        original_query=state.get("original_query", "—"),
-        last_sql=state.get("last_sql", "—"),
-        tool_result=last_tool_msg.content[:800],
-        schema_preview=schema_preview
-    )
+        DB_SCHEMA = await get_postgres_schema.ainvoke({})
+        _reset_schema_caches()
+    prompt = [
+        _critic_system_message(_schema_for_prompt()),
+        HumanMessage(content=CRITIC_TAIL.format(
+            original_query=state.get("original_query", "—"),
+            last_sql=state.get("last_sql", "—"),
+            tool_result=last_tool_msg.content[:800],
+        )),
+    ]
     
     try:
-        response = critic_llm.invoke(prompt)
+        response = await critic_llm.ainvoke(prompt)
         critic_text = response.content.strip()
         
         logger.info(f"🧐 Критика (попытка {critic_attempts}): {critic_text[:200]}")
@@ -315,6 +461,9 @@ def critic_node(state: AgentState):
             "critic_attempts": critic_attempts,
         }
 
+_CRITIC_LOOP_RE = re.compile("clients", re.IGNORECASE)
+
+
 def after_tools_decision(state: AgentState) -> str:
     logger.info("🔀 === РОУТЕР: after_tools_decision ===")
     
@@ -323,11 +472,32 @@ def after_tools_decision(state: AgentState) -> str:
     last_tool_msg = state["messages"][-1]
     tool_name = getattr(last_tool_msg, "name", "")
 
+    schema_calls = 0
+    critic_messages: deque = deque(maxlen=3)
+    zero_rows_in_current_request = 0
+    in_current_request = True
+    for m in reversed(state["messages"]):
+        m_type = getattr(m, "type", None)
+        if m_type == "human":
+            in_current_request = False
+        elif m_type == "tool":
+            if m.name == "get_postgres_schema":
+                schema_calls += 1
+            elif in_current_request and m.name == "run_sql":
+                r = _parsed(m)
+                try:
+                    if r and r.get("success") and int(r.get("row_count", -1)) == 0:
+                        zero_rows_in_current_request += 1
+                except Exception:
+                    pass
+        elif m_type == "ai" and getattr(m, "name", "") == "sql_critic":
+            if len(critic_messages) < critic_messages.maxlen:
+                critic_messages.appendleft(m)
+
+        if not in_current_request and schema_calls >= 2 and len(critic_messages) == critic_messages.maxlen:
+            break
+
     if tool_name == "get_postgres_schema":
-        schema_calls = sum(
-            1 for m in state["messages"]
-            if isinstance(m, ToolMessage) and m.name == "get_postgres_schema"
-        )
         if schema_calls >= 2:
             logger.warning(f"⚠️ Схема вызвана {schema_calls} раз → END")
             return END
@@ -336,13 +506,13 @@ def after_tools_decision(state: AgentState) -> str:
     if tool_name != "run_sql":
         return END 
 
-    try:
-        result = json.loads(last_tool_msg.content)
+    result = _parsed(last_tool_msg)
+    if result is not None:
         success = result.get("success", False)
         row_count = result.get("row_count", 0)
         error_text = result.get("error", "")
         is_connection_error = result.get("is_connection_error", False)
-    except (json.JSONDecodeError, ValueError, TypeError):
+    else:
         success = False
         row_count = 0
         error_text = last_tool_msg.content[:200]
@@ -355,28 +525,11 @@ def after_tools_decision(state: AgentState) -> str:
     has_error = not success or "error" in error_text.lower()
     has_no_data = row_count == 0
     
-    critic_messages = [
-        m for m in state["messages"] 
-        if isinstance(m, AIMessage) and getattr(m, "name", "") == "sql_critic"
-    ][-3:]
-    
     if len(critic_messages) >= 2:
-        last_two_texts = [m.content.lower() for m in critic_messages[-2:]]
-        if all("clients" in t for t in last_two_texts):
+        if all(_CRITIC_LOOP_RE.search(critic_messages[i].content) for i in (-2, -1)):
             logger.warning("⚠️ Критик зациклился на таблице 'clients' → assistant")
             return "assistant"
 
-        zero_rows_in_current_request = 0
-        for m in reversed(state["messages"]):
-            if isinstance(m, HumanMessage):
-                break
-            if isinstance(m, ToolMessage) and m.name == "run_sql":
-                try:
-                    r = json.loads(m.content)
-                    if r.get("success") and int(r.get("row_count", -1)) == 0:
-                        zero_rows_in_current_request += 1
-                except Exception:
-                    pass
         if zero_rows_in_current_request >= 3:
             logger.warning("⚠️ 3+ подряд запросов с 0 строк — критик зациклился → assistant")
             return "assistant"
@@ -465,4 +618,4 @@ def build_graph():
     
     return builder.compile(checkpointer=memory)
 
-graph = build_graph
+graph = build_graph()
@@ -1,19 +1,27 @@
+import asyncio
+import hashlib
+import io
+import json
 import logging
 import uuid
 import time
 import math
+import re
 from datetime import datetime
 from contextlib import asynccontextmanager
+from functools import lru_cache
+from typing import Annotated
 from html import escape
 
+import numpy as np
 import uvicorn
-from fastapi import FastAPI, HTTPException, Query
+from fastapi import BackgroundTasks, FastAPI, HTTPException, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import Response
-from pydantic import BaseModel
+from fastapi.responses import ORJSONResponse, Response
+from pydantic import BaseModel, ConfigDict, StringConstraints
 from langchain_core.messages import HumanMessage
 from langchain_core.documents import Document
-from langgraph.types import Command
+from langgraph.types import Command, Interrupt
 
 import database
 from config import CORS_ORIGINS
@@ -41,18 +49,46 @@ ERROR_KEYWORDS = [
     'ошибка', 'error', 'не могу', 'невозможно',
     'некорректн', 'не найден', 'failed', '{', 'success'
 ]
+_ERROR_RE = re.compile("|".join(map(re.escape, ERROR_KEYWORDS)), re.IGNORECASE)
 
 _last_schema_structured: dict | None = None
 _last_schema_source: str = "live"
 _last_schema_fallback_reason: str | None = None
 
 
+_LLM_ERROR_MAP = (
+    (
+        re.compile(r"tool_use_failed|failed_generation"),
+        502,
+        "Модель сгенерировала некорректный запрос. Пожалуйста, переформулируйте ваш вопрос.",
+    ),
+    (
+        re.compile(r"rate_limit", re.IGNORECASE),
+        429,
+        "Превышен лимит запросов к LLM. Подождите несколько секунд и попробуйте снова.",
+    ),
+)
+
+
+def _map_llm_error(error_str: str) -> HTTPException:
+    """HTTP-ошибка для исключения графа: известные сбои LLM → 502/429, остальное → 500."""
+    for pattern, status_code, detail in _LLM_ERROR_MAP:
+        if pattern.search(error_str):
+            return HTTPException(status_code=status_code, detail=detail)
+    return HTTPException(status_code=500, detail="Внутренняя ошибка сервера. Попробуйте ещё раз.")
+
+
 def _extract_interrupt_value(result: dict):
     """Извлекает payload из __interrupt__ (Interrupt namedtuple или dict)."""
     interrupts = result.get("__interrupt__", [])
     first = interrupts[0] if interrupts else None
     if first is None:
         return None
+    first_type = type(first)
+    if first_type is Interrupt:
+        return first.value
+    if first_type is dict:
+        return first.get("value", first)
     if hasattr(first, "value"):
         return first.value
     if isinstance(first, dict) and "value" in first:
@@ -60,43 +96,136 @@ def _extract_interrupt_value(result: dict):
     return first
 
 
-def _try_cache_response(query: str, response_text: str, data_rows, session_id: str):
-    """Пытается закэшировать ответ в Qdrant, если он не ошибочный."""
-    store = qdrant.get_active_vectorstore()
+CACHE_BATCH_SIZE = 32
+CACHE_FLUSH_INTERVAL = 0.2
+CACHE_QUEUE_MAX = 1024
+
+# Очередь и писатель создаются в lifespan: asyncio.Queue привязывается к циклу событий
+_cache_queue: asyncio.Queue | None = None
+_cache_writer_task: asyncio.Task | None = None
+
+
+_now_iso = ""
+_now_iso_epoch = 0
+
+
+def _cached_iso_now() -> str:
+    """Локальное время в ISO-формате с точностью до секунды; пересчитывается раз в секунду."""
+    global _now_iso, _now_iso_epoch
+    now = int(time.time())
+    if now != _now_iso_epoch:
+        _now_iso = datetime.fromtimestamp(now).isoformat()
+        _now_iso_epoch = now
+    return _now_iso
+
+
+async def _try_cache_response(query: str, response_text: str, data_rows, session_id: str, store=None):
+    """Ставит ответ в очередь на запись в Qdrant, если он не ошибочный."""
+    if _cache_queue is None or _cache_writer_task is None or _cache_writer_task.done():
+        return
+    if store is None:
+        store = qdrant.get_active_vectorstore()
     if not store or not qdrant.embeddings:
         return
     if not query:
         return
 
-    response = response_text.strip()
-    is_error = any(kw in response.lower() for kw in ERROR_KEYWORDS)
-
-    if is_error:
+    if _ERROR_RE.search(response_text):
         logger.info("⚠️ Ошибочный ответ не кэшируется")
         return
 
+    doc = Document(
+        page_content=query,
+        metadata={
+            'response': response_text.strip(),
+            'data': data_rows or [],
+            'timestamp': _cached_iso_now(),
+            'session_id': session_id,
+        }
+    )
     try:
-        doc = Document(
-            page_content=query,
-            metadata={
-                'response': response,
-                'data': data_rows or [],
-                'timestamp': datetime.now().isoformat(),
-                'session_id': session_id,
-            }
-        )
-        point_id = str(uuid.uuid4())
-        store.add_documents(documents=[doc], ids=[point_id])
-        logger.info(f"📥 Добавлено в Qdrant кэш | ID: {point_id[:8]}...")
-    except Exception as e:
-        logger.error(f"❌ Ошибка при добавлении в кэш: {e}")
+        _cache_queue.put_nowait((store, doc, str(uuid.uuid4())))
+    except asyncio.QueueFull:
+        logger.warning(f"⚠️ Очередь кэша переполнена ({CACHE_QUEUE_MAX}), ответ не кэшируется")
+
+
+def _flush_cache_batch(batch: list):
+    """Пишет накопленные ответы в Qdrant: один add_documents на коллекцию."""
+    by_store: dict[int, tuple] = {}
+    for store, doc, point_id in batch:
+        _store, docs, ids = by_store.setdefault(id(store), (store, [], []))
+        docs.append(doc)
+        ids.append(point_id)
+
+    for store, docs, ids in by_store.values():
+        try:
+            store.add_documents(documents=docs, ids=ids)
+            logger.info(f"📥 Добавлено в Qdrant кэш: {len(ids)} шт. | ID: {', '.join(i[:8] for i in ids)}")
+        except Exception as e:
+            logger.error(f"❌ Ошибка при добавлении в кэш: {e}")
+
+
+async def _cache_writer(queue: asyncio.Queue):
+    """Фоновая задача: собирает записи кэша пачками по размеру или по таймауту."""
+    loop = asyncio.get_running_loop()
+    while True:
+        batch = [await queue.get()]
+        deadline = loop.time() + CACHE_FLUSH_INTERVAL
+        try:
+            while len(batch) < CACHE_BATCH_SIZE:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+        except asyncio.CancelledError:
+            # Остановка посреди набора пачки: возвращаем записи, их допишет _drain_cache_queue
+            for item in batch:
+                try:
+                    queue.put_nowait(item)
+                except asyncio.QueueFull:
+                    logger.warning("⚠️ Очередь кэша переполнена при остановке, запись потеряна")
+            raise
+        await asyncio.to_thread(_flush_cache_batch, batch)
+
+
+def _drain_cache_queue(queue: asyncio.Queue):
+    """Синхронно дописывает всё, что осталось в очереди (при остановке сервера)."""
+    batch = []
+    while not queue.empty():
+        batch.append(queue.get_nowait())
+    if batch:
+        _flush_cache_batch(batch)
+
+
+def _on_cache_writer_done(task: asyncio.Task):
+    """Логирует падение писателя кэша: без него новые ответы перестают кэшироваться."""
+    if task.cancelled():
+        return
+    exc = task.exception()
+    if exc is not None:
+        logger.error(f"❌ Фоновая запись кэша остановилась с ошибкой: {exc!r}")
+
+
+async def _replace_cache_entry(reject_query: str, query: str, response_text: str, data_rows, session_id: str):
+    """Удаляет отклонённую пользователем запись кэша и кэширует новый ответ.
+
+    Порядок важен: новый ответ почти совпадает с отклонённым запросом, и удаление
+    после записи могло бы снести именно его. Vectorstore берётся один раз на оба вызова.
+    """
+    store = qdrant.get_active_vectorstore()
+    if reject_query:
+        await asyncio.to_thread(delete_cache_entry, reject_query, store=store)
+    await _try_cache_response(query, response_text, data_rows, session_id, store=store)
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     logger.info("🚀 Startup начинается...")
 
-    global _last_schema_structured
+    global _last_schema_structured, _cache_queue, _cache_writer_task
     try:
         init_database_pool()
         load_schema()
@@ -113,9 +242,7 @@ async def lifespan(app: FastAPI):
     if qdrant.get_active_vectorstore() is None:
         logger.warning("⚠️ Qdrant недоступен — приложение работает БЕЗ кэширования")
 
-    global graph
-    graph = build_graph()
-    logger.info("✅ Граф построен и сохранён глобально")
+    logger.info("✅ Граф скомпилирован при импорте agent.graph")
 
     if qdrant.get_active_vectorstore() is None:
         qdrant.start_reconnect_task(interval=30)
@@ -123,12 +250,27 @@ async def lifespan(app: FastAPI):
     else:
         logger.info("✅ Сервер полностью готов")
 
+    _cache_queue = asyncio.Queue(maxsize=CACHE_QUEUE_MAX)
+    _cache_writer_task = asyncio.create_task(_cache_writer(_cache_queue))
+    _cache_writer_task.add_done_callback(_on_cache_writer_done)
+
     yield
 
+    queue, writer = _cache_queue, _cache_writer_task
+    _cache_queue = _cache_writer_task = None
+    writer.cancel()
+    try:
+        await writer
+    except asyncio.CancelledError:
+        pass
+    except Exception:
+        pass  # уже залогировано в _on_cache_writer_done
+    _drain_cache_queue(queue)
+
     shutdown_database_pool()
 
 
-app = FastAPI(title='SQL Agent', lifespan=lifespan)
+app = FastAPI(title='SQL Agent', lifespan=lifespan, default_response_class=ORJSONResponse)
 
 _default_origins = ["http://localhost:3000", "http://127.0.0.1:3000"]
 app.add_middleware(
@@ -140,14 +282,22 @@ app.add_middleware(
 )
 
 
+_StrippedStr = Annotated[str, StringConstraints(strip_whitespace=True)]
+
+
 class MessageRequest(BaseModel):
+    # strip выполняется в pydantic-core при валидации тела, а не отдельной копией в обработчике
+    model_config = ConfigDict(frozen=True)
+
     session_id: str
-    message: str | None = None
-    question: str | None = None
+    message: _StrippedStr | None = None
+    question: _StrippedStr | None = None
     mode: str | None = None
 
 
 class ResumeRequest(BaseModel):
+    model_config = ConfigDict(frozen=True)
+
     session_id: str
     data: dict
 
@@ -173,15 +323,33 @@ class DbConnectRequest(BaseModel):
     profile: DbConnectProfile
 
 
+STATUS_CACHE_TTL = 0.5
+
+_status_cache = {"ts": 0.0, "val": None}
+
+
+def _cached_db_status() -> dict:
+    """Снимок get_db_status() для частых проб (/health, /db/status), живёт STATUS_CACHE_TTL секунд."""
+    now = time.monotonic()
+    if _status_cache["val"] is None or now - _status_cache["ts"] >= STATUS_CACHE_TTL:
+        _status_cache["val"] = get_db_status()
+        _status_cache["ts"] = now
+    return _status_cache["val"]
+
+
+def _invalidate_db_status():
+    _status_cache["val"] = None
+
+
 @app.get("/health")
 async def health():
-    status = get_db_status()
+    status = _cached_db_status()
     return {"ok": True, **status}
 
 
 @app.get("/db/status")
 async def db_status():
-    return get_db_status()
+    return _cached_db_status()
 
 
 @app.post("/db/connect")
@@ -210,11 +378,14 @@ async def db_connect(request: DbConnectRequest):
         raise
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"Ошибка подключения к БД: {e}")
+    finally:
+        _invalidate_db_status()
 
 
 @app.post("/db/disconnect")
 async def db_disconnect():
     shutdown_database_pool()
+    _invalidate_db_status()
     return {"ok": True, "connected": False}
 
 
@@ -262,7 +433,7 @@ async def api_db_schema(refresh: bool = Query(default=False)):
             fallback_meta["source"] = "cache"
             fallback_meta["is_fallback"] = True
             fallback_meta["fallback_reason"] = str(e)
-            fallback_meta["fallback_at"] = int(datetime.now().timestamp())
+            fallback_meta["fallback_at"] = int(time.time())
             fallback["metadata"] = fallback_meta
             _last_schema_source = "cache"
             _last_schema_fallback_reason = str(e)
@@ -271,29 +442,69 @@ async def api_db_schema(refresh: bool = Query(default=False)):
         raise HTTPException(status_code=500, detail=f"Ошибка получения схемы: {e}")
 
 
+# \W — всё, кроме str.isalnum() и "_": те же символы, что заменял посимвольный цикл
+_NON_ID_CHARS_RE = re.compile(r"\W")
+
+
+@lru_cache(maxsize=4096)
 def _port_id(name: str) -> str:
-    safe = "".join(ch if ch.isalnum() or ch == "_" else "_" for ch in str(name))
+    safe = _NON_ID_CHARS_RE.sub("_", str(name))
     return safe or "col"
 
 
+@lru_cache(maxsize=4096)
 def _dom_id(value: str) -> str:
-    safe = "".join(ch if ch.isalnum() or ch == "_" else "_" for ch in str(value))
+    safe = _NON_ID_CHARS_RE.sub("_", str(value))
     return safe or "id"
 
 
-def _build_erd_dot(schema: dict) -> str:
+_FLAG_PK = 1
+_FLAG_FK = 2
+_FLAG_MARKS = {0: "", _FLAG_PK: "[PK] ", _FLAG_FK: "[FK] ", _FLAG_PK | _FLAG_FK: "[PK,FK] "}
+
+
+def _flatten_schema(schema: dict) -> tuple[list[str], dict[str, list[tuple[str, str, int]]], list[tuple[str, str, str, str]]]:
+    """Один проход по структурированной схеме для построителей ERD.
+
+    Возвращает отсортированные таблицы, колонки {table: [(name, type, flags)]}
+    с битовой маской _FLAG_PK | _FLAG_FK и внешние ключи (ft, fc, tt, tc) строками.
+    """
     tables = sorted(schema.get("tables", []))
     columns_map = schema.get("columns", {}) or {}
     pk_map = schema.get("primary_keys", {}) or {}
-    foreign_keys = schema.get("foreign_keys", []) or []
+
+    foreign_keys = [
+        (
+            str(fk.get("from_table", "")),
+            str(fk.get("from_column", "")),
+            str(fk.get("to_table", "")),
+            str(fk.get("to_column", "")),
+        )
+        for fk in schema.get("foreign_keys", []) or []
+    ]
 
     fk_cols_by_table: dict[str, set[str]] = {}
-    for fk in foreign_keys:
-        ft = str(fk.get("from_table", ""))
-        fc = str(fk.get("from_column", ""))
+    for ft, fc, _tt, _tc in foreign_keys:
         if ft and fc:
             fk_cols_by_table.setdefault(ft, set()).add(fc)
 
+    col_defs: dict[str, list[tuple[str, str, int]]] = {}
+    for table in tables:
+        pk_set = set(pk_map.get(table, []))
+        fk_set = fk_cols_by_table.get(table, set())
+        defs: list[tuple[str, str, int]] = []
+        for col in columns_map.get(table, []) or []:
+            name = str(col.get("name", ""))
+            flags = (_FLAG_PK if name in pk_set else 0) | (_FLAG_FK if name in fk_set else 0)
+            defs.append((name, str(col.get("type", "")), flags))
+        col_defs[table] = defs
+
+    return tables, col_defs, foreign_keys
+
+
+def _build_erd_dot(schema: dict) -> str:
+    tables, col_defs, foreign_keys = _flatten_schema(schema)
+
     lines = [
         "digraph ERD {",
         "  rankdir=LR;",
@@ -303,41 +514,27 @@ def _build_erd_dot(schema: dict) -> str:
     ]
 
     for table in tables:
-        pk_set = set(pk_map.get(table, []))
-        fk_set = fk_cols_by_table.get(table, set())
-        cols = columns_map.get(table, []) or []
+        cols = col_defs[table]
 
-        rows = [
+        lines.append(f'  "{table}" [label=<')
+        lines.append("  <TABLE BORDER=\"1\" CELLBORDER=\"0\" CELLSPACING=\"0\" CELLPADDING=\"4\" COLOR=\"#334155\">")
+        lines.append(
             f'    <TR><TD COLSPAN="2" BGCOLOR="#0f172a"><FONT COLOR="white"><B>{escape(str(table))}</B></FONT></TD></TR>'
-        ]
+        )
 
         if not cols:
-            rows.append('    <TR><TD ALIGN="LEFT" COLSPAN="2"><FONT COLOR="#64748b">нет колонок</FONT></TD></TR>')
+            lines.append('    <TR><TD ALIGN="LEFT" COLSPAN="2"><FONT COLOR="#64748b">нет колонок</FONT></TD></TR>')
         else:
-            for col in cols:
-                name = str(col.get("name", ""))
-                typ = str(col.get("type", ""))
-                mark = []
-                if name in pk_set:
-                    mark.append("PK")
-                if name in fk_set:
-                    mark.append("FK")
-                mark_text = f"[{','.join(mark)}] " if mark else ""
+            for name, typ, flags in cols:
                 port = _port_id(name)
-                rows.append(
-                    f'    <TR><TD PORT="{port}" ALIGN="LEFT">{escape(mark_text + name)}</TD><TD ALIGN="LEFT"><FONT COLOR="#475569">{escape(typ)}</FONT></TD></TR>'
+                lines.append(
+                    f'    <TR><TD PORT="{port}" ALIGN="LEFT">{_FLAG_MARKS[flags]}{escape(name)}</TD><TD ALIGN="LEFT"><FONT COLOR="#475569">{escape(typ)}</FONT></TD></TR>'
                 )
 
-        label = "<\n  <TABLE BORDER=\"1\" CELLBORDER=\"0\" CELLSPACING=\"0\" CELLPADDING=\"4\" COLOR=\"#334155\">\n"
-        label += "\n".join(rows)
-        label += "\n  </TABLE>\n>"
-        lines.append(f'  "{table}" [label={label}];')
+        lines.append("  </TABLE>")
+        lines.append(">];")
 
-    for fk in foreign_keys:
-        ft = str(fk.get("from_table", ""))
-        fc = str(fk.get("from_column", ""))
-        tt = str(fk.get("to_table", ""))
-        tc = str(fk.get("to_column", ""))
+    for ft, fc, tt, tc in foreign_keys:
         if not (ft and tt):
             continue
 
@@ -355,19 +552,10 @@ def _build_erd_dot(schema: dict) -> str:
 
 
 def _build_erd_svg(schema: dict) -> str:
-    tables = sorted(schema.get("tables", []))
-    columns_map = schema.get("columns", {}) or {}
-    pk_map = schema.get("primary_keys", {}) or {}
-    foreign_keys = schema.get("foreign_keys", []) or []
-
-    fk_cols_by_table: dict[str, set[str]] = {}
-    for fk in foreign_keys:
-        ft = str(fk.get("from_table", ""))
-        fc = str(fk.get("from_column", ""))
-        if ft and fc:
-            fk_cols_by_table.setdefault(ft, set()).add(fc)
+    tables, col_defs, foreign_keys = _flatten_schema(schema)
 
-    col_defs: dict[str, list[tuple[str, str, bool, bool]]] = {}
+    col_defs_escaped: dict[str, list[tuple[str, str, int]]] = {}
+    escaped_tables: dict[str, str] = {}
     table_heights: dict[str, int] = {}
 
     header_h = 32
@@ -378,15 +566,9 @@ def _build_erd_svg(schema: dict) -> str:
     gap_y = 34
 
     for table in tables:
-        pk_set = set(pk_map.get(table, []))
-        fk_set = fk_cols_by_table.get(table, set())
-        cols_raw = columns_map.get(table, []) or []
-        defs: list[tuple[str, str, bool, bool]] = []
-        for col in cols_raw:
-            name = str(col.get("name", ""))
-            typ = str(col.get("type", ""))
-            defs.append((name, typ, name in pk_set, name in fk_set))
-        col_defs[table] = defs
+        defs = col_defs[table]
+        col_defs_escaped[table] = [(escape(n), escape(t), flags) for n, t, flags in defs]
+        escaped_tables[table] = escape(table)
         visible_rows = max(1, len(defs))
         table_heights[table] = header_h + visible_rows * row_h + 10
 
@@ -421,147 +603,219 @@ def _build_erd_svg(schema: dict) -> str:
     for table in tables:
         x, y0 = positions[table]
         defs = col_defs.get(table, [])
-        for idx, (name, _typ, _is_pk, _is_fk) in enumerate(defs):
+        for idx, (name, _typ, _flags) in enumerate(defs):
             yy = y0 + header_h + 5 + idx * row_h + row_h / 2
             col_anchor[(table, name)] = (x, yy)
 
-    edge_groups: list[str] = []
-    for fk in foreign_keys:
-        ft = str(fk.get("from_table", ""))
-        fc = str(fk.get("from_column", ""))
-        tt = str(fk.get("to_table", ""))
-        tc = str(fk.get("to_column", ""))
+    buf = io.StringIO()
+    write = buf.write
+    write(
+        f'<svg xmlns="http://www.w3.org/2000/svg" width="{width}" height="{height}" viewBox="0 0 {width} {height}">'
+        '<defs><marker id="arrow" markerWidth="10" markerHeight="8" refX="9" refY="4" orient="auto" markerUnits="strokeWidth">'
+        '<path d="M0,0 L10,4 L0,8 z" fill="#475569"/></marker></defs>'
+        '<rect width="100%" height="100%" fill="#f8fafc"/>'
+    )
+
+    edges: list[tuple[str, str, str, str]] = []
+    edge_coords: list[tuple[float, float, float, float]] = []
+    for ft, fc, tt, tc in foreign_keys:
         if ft not in positions or tt not in positions:
             continue
 
         fx, fy = positions[ft]
         tx, ty = positions[tt]
-
         from_anchor = col_anchor.get((ft, fc))
         to_anchor = col_anchor.get((tt, tc))
-
-        if from_anchor is None:
-            from_anchor = (fx + node_w, fy + header_h / 2)
-        if to_anchor is None:
-            to_anchor = (tx, ty + header_h / 2)
-
+        start_y = from_anchor[1] if from_anchor is not None else fy + header_h / 2
+        end_y = to_anchor[1] if to_anchor is not None else ty + header_h / 2
+        edges.append((ft, fc, tt, tc))
+        edge_coords.append((fx, tx, start_y, end_y))
+
+    if edges:
+        # Геометрия всех рёбер считается векторно; Python-цикл ниже только форматирует строки
+        fx, tx, start_y, end_y = np.asarray(edge_coords, dtype=np.float64).T
         from_left_to_right = fx <= tx
-        start_x = fx + node_w if from_left_to_right else fx
-        end_x = tx if from_left_to_right else tx + node_w
-        start_y = from_anchor[1]
-        end_y = to_anchor[1]
-        dx = abs(end_x - start_x)
-        c = max(40, dx * 0.35)
-        c1x = start_x + c if from_left_to_right else start_x - c
-        c2x = end_x - c if from_left_to_right else end_x + c
-
-        edge_id = f"{_dom_id(ft)}__{_dom_id(fc)}__to__{_dom_id(tt)}__{_dom_id(tc)}"
-        edge_items = [
-            f'<path class="erd-edge-path" d="M {start_x:.1f} {start_y:.1f} C {c1x:.1f} {start_y:.1f}, {c2x:.1f} {end_y:.1f}, {end_x:.1f} {end_y:.1f}" '
-            f'stroke="#475569" stroke-width="1.4" fill="none" marker-end="url(#arrow)"/>'
-        ]
-        if fc and tc:
-            lx = (start_x + end_x) / 2
-            ly = (start_y + end_y) / 2 - 4
-            edge_items.append(
-                f'<text x="{lx:.1f}" y="{ly:.1f}" font-family="Arial" font-size="10" fill="#334155">{escape(fc)}→{escape(tc)}</text>'
-            )
-        edge_groups.append(
-            f'<g class="erd-edge" id="edge_{edge_id}" data-from-table="{escape(ft)}" data-to-table="{escape(tt)}" '
-            f'data-from-column="{escape(fc)}" data-to-column="{escape(tc)}">'
-            f'{"".join(edge_items)}'
-            "</g>"
+        start_x = np.where(from_left_to_right, fx + node_w, fx)
+        end_x = np.where(from_left_to_right, tx, tx + node_w)
+        c = np.maximum(40, np.abs(end_x - start_x) * 0.35)
+        c1x = np.where(from_left_to_right, start_x + c, start_x - c)
+        c2x = np.where(from_left_to_right, end_x - c, end_x + c)
+        lx = (start_x + end_x) / 2
+        ly = (start_y + end_y) / 2 - 4
+
+        edge_geometry = zip(
+            edges,
+            start_x.tolist(), start_y.tolist(), end_x.tolist(), end_y.tolist(),
+            c1x.tolist(), c2x.tolist(), lx.tolist(), ly.tolist(),
         )
+        for (ft, fc, tt, tc), sx, sy, ex, ey, cx1, cx2, mx, my in edge_geometry:
+            fc_esc = escape(fc)
+            tc_esc = escape(tc)
+            edge_id = f"{_dom_id(ft)}__{_dom_id(fc)}__to__{_dom_id(tt)}__{_dom_id(tc)}"
+            write(
+                f'<g class="erd-edge" id="edge_{edge_id}" data-from-table="{escaped_tables[ft]}" data-to-table="{escaped_tables[tt]}" '
+                f'data-from-column="{fc_esc}" data-to-column="{tc_esc}">'
+                f'<path class="erd-edge-path" d="M {sx:.1f} {sy:.1f} C {cx1:.1f} {sy:.1f}, {cx2:.1f} {ey:.1f}, {ex:.1f} {ey:.1f}" '
+                f'stroke="#475569" stroke-width="1.4" fill="none" marker-end="url(#arrow)"/>'
+            )
+            if fc and tc:
+                write(
+                    f'<text x="{mx:.1f}" y="{my:.1f}" font-family="Arial" font-size="10" fill="#334155">{fc_esc}→{tc_esc}</text>'
+                )
+            write("</g>")
 
-    table_groups: list[str] = []
     for table in tables:
         x, y0 = positions[table]
         h = table_heights[table]
-        defs = col_defs.get(table, [])
+        defs = col_defs_escaped.get(table, [])
+        table_esc = escaped_tables[table]
         table_id = _dom_id(table)
-        node_items = [
-            f'<rect class="erd-table-body" x="{x}" y="{y0}" width="{node_w}" height="{h}" rx="8" ry="8" fill="#ffffff" stroke="#334155" stroke-width="1.2"/>',
-            f'<rect class="erd-table-header" x="{x}" y="{y0}" width="{node_w}" height="{header_h}" rx="8" ry="8" fill="#0f172a"/>',
-            f'<text class="erd-table-title" x="{x + 10}" y="{y0 + 21}" font-family="Arial" font-size="13" font-weight="700" fill="#ffffff">{escape(table)}</text>',
-        ]
+        write(
+            f'<g class="erd-table" id="table_{table_id}" data-table="{table_esc}">'
+            f'<rect class="erd-table-body" x="{x}" y="{y0}" width="{node_w}" height="{h}" rx="8" ry="8" fill="#ffffff" stroke="#334155" stroke-width="1.2"/>'
+            f'<rect class="erd-table-header" x="{x}" y="{y0}" width="{node_w}" height="{header_h}" rx="8" ry="8" fill="#0f172a"/>'
+            f'<text class="erd-table-title" x="{x + 10}" y="{y0 + 21}" font-family="Arial" font-size="13" font-weight="700" fill="#ffffff">{table_esc}</text>'
+        )
 
         if not defs:
-            node_items.append(
+            write(
                 f'<text x="{x + 10}" y="{y0 + header_h + 18}" font-family="Arial" font-size="12" fill="#64748b">нет колонок</text>'
             )
         else:
-            for idx, (name, typ, is_pk, is_fk) in enumerate(defs):
+            for idx, (name_esc, typ_esc, flags) in enumerate(defs):
                 yy = y0 + header_h + 5 + idx * row_h
                 if idx > 0:
-                    node_items.append(
+                    write(
                         f'<line x1="{x + 1}" y1="{yy}" x2="{x + node_w - 1}" y2="{yy}" stroke="#e2e8f0" stroke-width="1"/>'
                     )
-                flags = []
-                if is_pk:
-                    flags.append("PK")
-                if is_fk:
-                    flags.append("FK")
-                flag_text = f"[{','.join(flags)}] " if flags else ""
-                node_items.append(
-                    f'<text class="erd-col-name" data-column="{escape(name)}" x="{x + 10}" y="{yy + 14}" font-family="Arial" font-size="11" fill="#0f172a">{escape(flag_text + name)}</text>'
-                )
-                node_items.append(
-                    f'<text class="erd-col-type" x="{x + node_w - 10}" y="{yy + 14}" text-anchor="end" font-family="Arial" font-size="10" fill="#64748b">{escape(typ)}</text>'
+                write(
+                    f'<text class="erd-col-name" data-column="{name_esc}" x="{x + 10}" y="{yy + 14}" font-family="Arial" font-size="11" fill="#0f172a">{_FLAG_MARKS[flags]}{name_esc}</text>'
+                    f'<text class="erd-col-type" x="{x + node_w - 10}" y="{yy + 14}" text-anchor="end" font-family="Arial" font-size="10" fill="#64748b">{typ_esc}</text>'
                 )
-        table_groups.append(
-            f'<g class="erd-table" id="table_{table_id}" data-table="{escape(table)}">{"".join(node_items)}</g>'
-        )
+        write("</g>")
 
     legend_x = margin
     legend_y = height - margin - 16
-    legend = (
+    write(
         f'<text x="{legend_x}" y="{legend_y}" font-family="Arial" font-size="11" fill="#475569">'
         "Обозначения: [PK] первичный ключ, [FK] внешний ключ, стрелка = связь FK → PK"
         "</text>"
-    )
-
-    return (
-        f'<svg xmlns="http://www.w3.org/2000/svg" width="{width}" height="{height}" viewBox="0 0 {width} {height}">'
-        '<defs><marker id="arrow" markerWidth="10" markerHeight="8" refX="9" refY="4" orient="auto" markerUnits="strokeWidth">'
-        '<path d="M0,0 L10,4 L0,8 z" fill="#475569"/></marker></defs>'
-        '<rect width="100%" height="100%" fill="#f8fafc"/>'
-        f'{"".join(edge_groups)}{"".join(table_groups)}{legend}'
         "</svg>"
     )
+    return buf.getvalue()
+
+
+_ERD_MEDIA_TYPES = {
+    "svg": "image/svg+xml; charset=utf-8",
+    "dot": "text/vnd.graphviz; charset=utf-8",
+}
+_ERD_CACHE_MAX = 8
+_erd_cache: dict[tuple[str, str], bytes] = {}
+
+
+def _schema_fingerprint(schema: dict) -> str:
+    """Хэш той части схемы, из которой строится ERD (без metadata с временем генерации)."""
+    payload = {key: schema.get(key) for key in ("tables", "columns", "primary_keys", "foreign_keys")}
+    raw = json.dumps(payload, sort_keys=True, default=str, ensure_ascii=False).encode("utf-8")
+    return hashlib.blake2b(raw, digest_size=16).hexdigest()
+
+
+def _render_erd(schema: dict, fmt: str, fingerprint: str) -> bytes:
+    """ERD в формате fmt; готовые байты кэшируются по отпечатку схемы."""
+    key = (fingerprint, fmt)
+    body = _erd_cache.get(key)
+    if body is None:
+        text = _build_erd_dot(schema) if fmt == "dot" else _build_erd_svg(schema)
+        body = text.encode("utf-8")
+        if len(_erd_cache) >= _ERD_CACHE_MAX:
+            _erd_cache.clear()
+        _erd_cache[key] = body
+    return body
+
+
+def _etag_matches(if_none_match: str | None, etag: str) -> bool:
+    if not if_none_match:
+        return False
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate == "*" or candidate.removeprefix("W/") == etag:
+            return True
+    return False
 
 
 @app.get("/api/db/schema/erd")
-async def api_db_schema_erd(format: str = Query(default="svg"), refresh: bool = Query(default=False)):
+async def api_db_schema_erd(
+    request: Request,
+    format: str = Query(default="svg"),
+    refresh: bool = Query(default=False),
+):
     try:
-        schema = await api_db_schema(refresh=refresh)
-        dot = _build_erd_dot(schema)
-
-        if format == "dot":
-            return Response(content=dot, media_type="text/vnd.graphviz; charset=utf-8")
-        if format != "svg":
+        if format not in _ERD_MEDIA_TYPES:
             raise HTTPException(status_code=400, detail="Поддерживаются только format=svg|dot")
 
-        svg = _build_erd_svg(schema)
-        return Response(content=svg, media_type="image/svg+xml; charset=utf-8")
+        schema = await api_db_schema(refresh=refresh)
+        fingerprint = _schema_fingerprint(schema)
+        # no-cache: браузер всегда переспрашивает (после /db/connect URL тот же, а схема другая),
+        # но при совпадении ETag получает пустой 304 вместо всей диаграммы
+        headers = {"ETag": f'"{fingerprint}-{format}"', "Cache-Control": "private, no-cache"}
+        if _etag_matches(request.headers.get("if-none-match"), headers["ETag"]):
+            return Response(status_code=304, headers=headers)
+
+        return Response(
+            content=_render_erd(schema, format, fingerprint),
+            media_type=_ERD_MEDIA_TYPES[format],
+            headers=headers,
+        )
     except HTTPException:
         raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Ошибка построения ERD: {e}")
 
 
+@lru_cache(maxsize=4096)
+def _thread_config(session_id: str) -> dict:
+    """Общий config графа для сессии; LangGraph его не изменяет, поэтому объект переиспользуется."""
+    return {"configurable": {"thread_id": session_id}}
+
+
+# Single-flight: одинаковые (session_id, message), пришедшие пока граф ещё считает,
+# ждут тот же прогон вместо повторных вызовов LLM и БД
+_chat_in_flight: dict[tuple[str, str], asyncio.Task] = {}
+
+
+def _finish_in_flight(key: tuple[str, str], task: asyncio.Task):
+    _chat_in_flight.pop(key, None)
+    if not task.cancelled():
+        task.exception()  # помечаем исключение полученным, даже если все ожидающие отменены
+
+
 @app.post("/chat")
-async def chat(request: MessageRequest):
+async def chat(request: MessageRequest, background_tasks: BackgroundTasks):
 
     if graph is None:
         raise HTTPException(status_code=503, detail="Сервер еще загружается, попробуйте позже")
 
-    user_message = (request.message or request.question or "").strip()
+    user_message = request.message or request.question or ""
     if not user_message:
         raise HTTPException(status_code=400, detail="message (или question) обязателен")
 
+    key = (request.session_id, user_message)
+    task = _chat_in_flight.get(key)
+    if task is None:
+        task = asyncio.create_task(_run_chat(request, user_message, background_tasks))
+        _chat_in_flight[key] = task
+        task.add_done_callback(lambda t: _finish_in_flight(key, t))
+    else:
+        logger.info(f"🔗 Повторный запрос [{request.session_id}] ждёт уже выполняющийся граф")
+
+    # shield: отмена одного из ожидающих HTTP-запросов не должна прерывать общий прогон графа
+    return await asyncio.shield(task)
+
+
+async def _run_chat(request: MessageRequest, user_message: str, background_tasks: BackgroundTasks) -> dict:
     logger.info(f"💬 Запрос [{request.session_id}]: {user_message}")
     start_time = time.perf_counter()
-    config = {"configurable": {"thread_id": request.session_id}}
+    config = _thread_config(request.session_id)
     input_data = {"messages": [HumanMessage(content=user_message)]}
 
     try:
@@ -589,7 +843,8 @@ async def chat(request: MessageRequest):
         execution_time = time.perf_counter() - start_time
 
         if result.get("from_cache") is not True:
-            _try_cache_response(user_message, final_content, data_rows, request.session_id)
+            # В очередь записи Qdrant — после отправки ответа; сама запись идёт пачками в _cache_writer
+            background_tasks.add_task(_try_cache_response, user_message, final_content, data_rows, request.session_id)
 
         logger.info(f"✅ Успешно за {execution_time:.2f}s")
 
@@ -607,28 +862,18 @@ async def chat(request: MessageRequest):
     except Exception as e:
         error_str = str(e)
         logger.error(f"❌ Ошибка в /chat: {error_str[:500]}")
-        if "tool_use_failed" in error_str or "failed_generation" in error_str:
-            raise HTTPException(
-                status_code=502,
-                detail="Модель сгенерировала некорректный запрос. Пожалуйста, переформулируйте ваш вопрос."
-            )
-        if "rate_limit" in error_str.lower():
-            raise HTTPException(
-                status_code=429,
-                detail="Превышен лимит запросов к LLM. Подождите несколько секунд и попробуйте снова."
-            )
-        raise HTTPException(status_code=500, detail="Внутренняя ошибка сервера. Попробуйте ещё раз.")
+        raise _map_llm_error(error_str)
 
 
 @app.post("/chat/resume")
-async def chat_resume(request: ResumeRequest):
+async def chat_resume(request: ResumeRequest, background_tasks: BackgroundTasks):
 
     if graph is None:
         raise HTTPException(status_code=503, detail="Сервер еще загружается, попробуйте позже")
 
     logger.info(f"🔁 Резюмирование сессии [{request.session_id}] с человеческим вводом")
     start_time = time.perf_counter()
-    config = {"configurable": {"thread_id": request.session_id}}
+    config = _thread_config(request.session_id)
 
     try:
         result = await graph.ainvoke(Command(resume=request.data), config)
@@ -658,10 +903,10 @@ async def chat_resume(request: ResumeRequest):
             original_query = (result.get("original_query") or "").strip()
 
             reject_query = (result.get("cache_reject_query") or "").strip()
-            if reject_query:
-                delete_cache_entry(reject_query)
 
-            _try_cache_response(original_query, final_content, data_rows, request.session_id)
+            background_tasks.add_task(
+                _replace_cache_entry, reject_query, original_query, final_content, data_rows, request.session_id
+            )
 
         logger.info(f"✅ (resume) Успешно за {execution_time:.2f}s")
 
@@ -679,18 +924,9 @@ async def chat_resume(request: ResumeRequest):
     except Exception as e:
         error_str = str(e)
         logger.error(f"❌ Ошибка в /chat/resume: {error_str[:500]}")
-        if "tool_use_failed" in error_str or "failed_generation" in error_str:
-            raise HTTPException(
-                status_code=502,
-                detail="Модель сгенерировала некорректный запрос. Пожалуйста, переформулируйте ваш вопрос."
-            )
-        if "rate_limit" in error_str.lower():
-            raise HTTPException(
-                status_code=429,
-                detail="Превышен лимит запросов к LLM. Подождите несколько секунд и попробуйте снова."
-            )
-        raise HTTPException(status_code=500, detail="Внутренняя ошибка сервера. Попробуйте ещё раз.")
+        raise _map_llm_error(error_str)
 
 
 if __name__ == "__main__":
-    uvicorn.run("app:app", host="0.0.0.0", port=8000, reload=True)
+    # loop/http="auto" берут uvloop и httptools, если они установлены (см. requirements.txt)
+    uvicorn.run("app:app", host="0.0.0.0", port=8000, reload=True, loop="auto", http="auto")
@@ -246,9 +246,10 @@ def checked_cache(state: AgentState):
         return updates
 
 
-def delete_cache_entry(query: str):
+def delete_cache_entry(query: str, store: QdrantVectorStore | None = None):
     """Находит и удаляет ближайшую запись кэша для данного запроса."""
-    store = get_active_vectorstore()
+    if store is None:
+        store = get_active_vectorstore()
     if not store or not embeddings:
         return
 